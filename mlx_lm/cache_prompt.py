@@ -70,6 +70,14 @@ def setup_arg_parser():
         help="Group size for KV cache quantization.",
         default=64,
     )
+    parser.add_argument(
+        "--kv-quant-mode",
+        type=str,
+        choices=["affine", "mxfp4", "mxfp8", "nvfp4"],
+        help="Quantization mode for the KV cache. The floating point modes "
+        "set their own group size and bits.",
+        default="affine",
+    )
     parser.add_argument(
         "--quantized-kv-start",
         help="When --kv-bits is set, start quantizing the KV cache "
@@ -130,6 +138,7 @@ def main():
         prompt_cache=cache,
         kv_bits=args.kv_bits,
         kv_group_size=args.kv_group_size,
+        kv_quant_mode=args.kv_quant_mode,
         quantized_kv_start=args.quantized_kv_start,
         prompt_progress_callback=callback,
     ):
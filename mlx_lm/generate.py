@@ -32,6 +32,7 @@ from .models.cache import (
     KVCache,
     QuantizedKVCache,
     RotatingKVCache,
+    _fit_group_size,
     load_prompt_cache,
 )
 from .sample_utils import make_sampler
@@ -190,6 +191,14 @@ def setup_arg_parser():
         help="Group size for KV cache quantization.",
         default=64,
     )
+    parser.add_argument(
+        "--kv-quant-mode",
+        type=str,
+        choices=["affine", "mxfp4", "mxfp8", "nvfp4"],
+        help="Quantization mode for the KV cache. The floating point modes "
+        "set their own group size and bits.",
+        default="affine",
+    )
     parser.add_argument(
         "--quantized-kv-start",
         help="When --kv-bits is set, start quantizing the KV cache "
@@ -286,12 +295,45 @@ class GenerationResponse:
     finish_reason: Optional[str] = None
 
 
-def maybe_quantize_kv_cache(prompt_cache, quantized_kv_start, kv_group_size, kv_bits):
-    if kv_bits is None:
+def maybe_quantize_kv_cache(
+    prompt_cache, quantized_kv_start, kv_group_size, kv_bits, kv_quant_mode="affine"
+):
+    # The floating point modes fix their own bits so they don't need kv_bits
+    if kv_bits is None and kv_quant_mode == "affine":
         return
     for e, c in enumerate(prompt_cache):
         if hasattr(c, "to_quantized") and c.offset >= quantized_kv_start:
-            prompt_cache[e] = c.to_quantized(group_size=kv_group_size, bits=kv_bits)
+            prompt_cache[e] = c.to_quantized(
+                group_size=kv_group_size, bits=kv_bits, mode=kv_quant_mode
+            )
+
+
+def check_quantized_prompt_cache(
+    prompt_cache, kv_bits, kv_group_size, kv_quant_mode="affine"
+):
+    """
+    Raise if a loaded quantized prompt cache doesn't match the requested KV
+    cache quantization.
+    """
+    c = prompt_cache[0]
+    if not isinstance(c, QuantizedKVCache):
+        return
+    if kv_bits is not None and kv_bits != c.bits:
+        raise ValueError(
+            "--kv-bits does not match the kv cache loaded from --prompt-cache-file."
+        )
+    if kv_quant_mode != c.mode:
+        raise ValueError(
+            "--kv-quant-mode does not match the kv cache loaded from --prompt-cache-file."
+        )
+    if kv_quant_mode == "affine":
+        # Groups larger than the head dim were reduced when the cache was made
+        el_per_int = 8 * mx.uint32.size // c.bits
+        head_dims = (x[0].shape[-1] * el_per_int for x in (c.keys, c.values))
+        if _fit_group_size(kv_group_size, kv_quant_mode, *head_dims) != c.group_size:
+            raise ValueError(
+                "--kv-group-size does not match the kv cache loaded from --prompt-cache-file."
+            )
 
 
 def generate_step(
@@ -306,6 +348,7 @@ def generate_step(
     prefill_step_size: int = 2048,
     kv_bits: Optional[int] = None,
     kv_group_size: int = 64,
+    kv_quant_mode: str = "affine",
     quantized_kv_start: int = 0,
     prompt_progress_callback: Optional[Callable[[int, int], None]] = None,
     input_embeddings: Optional[mx.array] = None,
@@ -331,6 +374,9 @@ def generate_step(
         kv_bits (int, optional): Number of bits to use for KV cache quantization.
           None implies no cache quantization. Default: ``None``.
         kv_group_size (int): Group size for KV cache quantization. Default: ``64``.
+        kv_quant_mode (str): KV cache quantization mode, ``"affine"`` or one of
+          the floating point modes ``"mxfp4"``, ``"mxfp8"`` and ``"nvfp4"``,
+          which set their own group size and bits. Default: ``"affine"``.
         quantized_kv_start (int): Step to begin using a quantized KV cache.
            when ``kv_bits`` is non-None. Default: ``0``.
         prompt_progress_callback (Callable[[int, int], None]): A call-back which takes the
@@ -371,6 +417,7 @@ def generate_step(
         quantized_kv_start=quantized_kv_start,
         kv_group_size=kv_group_size,
         kv_bits=kv_bits,
+        kv_quant_mode=kv_quant_mode,
     )
 
     sampler = sampler or (lambda x: mx.argmax(x, axis=-1))
@@ -473,6 +520,7 @@ def speculative_generate_step(
     prefill_step_size: int = 512,
     kv_bits: Optional[int] = None,
     kv_group_size: int = 64,
+    kv_quant_mode: str = "affine",
     quantized_kv_start: int = 0,
 ) -> Generator[Tuple[mx.array, mx.array, bool], None, None]:
     """
@@ -497,6 +545,9 @@ def speculative_generate_step(
         kv_bits (int, optional): Number of bits to use for KV cache quantization.
           None implies no cache quantization. Default: ``None``.
         kv_group_size (int): Group size for KV cache quantization. Default: ``64``.
+        kv_quant_mode (str): KV cache quantization mode, ``"affine"`` or one of
+          the floating point modes ``"mxfp4"``, ``"mxfp8"`` and ``"nvfp4"``,
+          which set their own group size and bits. Default: ``"affine"``.
         quantized_kv_start (int): Step to begin using a quantized KV cache.
            when ``kv_bits`` is non-None. Default: ``0``.
 
@@ -523,6 +574,7 @@ def speculative_generate_step(
         quantized_kv_start=quantized_kv_start,
         kv_group_size=kv_group_size,
         kv_bits=kv_bits,
+        kv_quant_mode=kv_quant_mode,
     )
 
     def _process_and_sample(tokens, logits):
@@ -1341,15 +1393,9 @@ def main():
             args.prompt_cache_file,
             return_metadata=True,
         )
-        if isinstance(prompt_cache[0], QuantizedKVCache):
-            if args.kv_bits is not None and args.kv_bits != prompt_cache[0].bits:
-                raise ValueError(
-                    "--kv-bits does not match the kv cache loaded from --prompt-cache-file."
-                )
-            if args.kv_group_size != prompt_cache[0].group_size:
-                raise ValueError(
-                    "--kv-group-size does not match the kv cache loaded from --prompt-cache-file."
-                )
+        check_quantized_prompt_cache(
+            prompt_cache, args.kv_bits, args.kv_group_size, args.kv_quant_mode
+        )
 
     # Building tokenizer_config
     tokenizer_config = (
@@ -1443,6 +1489,7 @@ def main():
         prompt_cache=prompt_cache if using_cache else None,
         kv_bits=args.kv_bits,
         kv_group_size=args.kv_group_size,
+        kv_quant_mode=args.kv_quant_mode,
         quantized_kv_start=args.quantized_kv_start,
         draft_model=draft_model,
         num_draft_tokens=args.num_draft_tokens,
@@ -69,6 +69,7 @@ def quantized_scaled_dot_product_attention(
     mask: Optional[mx.array],
     group_size: int = 64,
     bits: int = 8,
+    mode: str = "affine",
 ) -> mx.array:
     B, n_q_heads, L, D = queries.shape
     n_kv_heads = q_keys[0].shape[-3]
@@ -82,25 +83,34 @@ def quantized_scaled_dot_product_attention(
         q_values = tree_map(lambda x: mx.expand_dims(x, axis=-3), q_values)
 
     scores = mx.quantized_matmul(
-        queries, *q_keys, transpose=True, group_size=group_size, bits=bits
+        queries,
+        *q_keys,
+        transpose=True,
+        group_size=group_size,
+        bits=bits,
+        mode=mode,
     )
+    if isinstance(mask, str):
+        # A single query attends to every key so it needs no causal mask
+        qL, kL = scores.shape[-2:]
+        mask = create_causal_mask(qL, kL - qL) if qL > 1 else None
     if mask is not None:
-        if isinstance(mask, str):
-            qL, kL = scores.shape[-2:]
-            q_indices = mx.arange(kL - qL, kL)
-            k_indices = mx.arange(kL)
-            mask = q_indices[:, None] >= k_indices[None]
         if mask.dtype == mx.bool_:
             scores = mx.where(mask, scores, mx.finfo(scores.dtype).min)
         else:
             scores += mask
     scores = mx.softmax(scores, axis=-1, precise=True)
     out = mx.quantized_matmul(
-        scores, *q_values, transpose=False, group_size=group_size, bits=bits
+        scores,
+        *q_values,
+        transpose=False,
+        group_size=group_size,
+        bits=bits,
+        mode=mode,
     )
 
     if n_repeats > 1:
-        out = mx.reshape(out, (B, n_q_heads, L, D))
+        out = mx.reshape(out, (B, n_q_heads, L, -1))
 
     return out
 
@@ -125,6 +135,7 @@ def scaled_dot_product_attention(
             mask=mask,
             group_size=cache.group_size,
             bits=cache.bits,
+            mode=cache.mode,
         )
     else:
         return mx.fast.scaled_dot_product_attention(
@@ -124,6 +124,26 @@ def create_attention_mask(
         return "causal"
 
 
+# The floating point quantization modes have a fixed group size and bits
+_FP_QUANT_MODES = {"mxfp4": (32, 4), "mxfp8": (32, 8), "nvfp4": (16, 4)}
+
+
+def _fit_group_size(group_size: int, mode: str, *head_dims: int) -> int:
+    """
+    Quantize whole rows when the head dimension is smaller than the group
+    size so a single scale and bias is stored per token and head.
+    """
+    head_dim = min(head_dims)
+    if (
+        mode == "affine"
+        and group_size > head_dim
+        and head_dim in (32, 64)
+        and all(d % head_dim == 0 for d in head_dims)
+    ):
+        return head_dim
+    return group_size
+
+
 class _BaseCache:
     @property
     def state(self):
@@ -221,26 +241,41 @@ class ConcatenateKVCache(_BaseCache):
 class QuantizedKVCache(_BaseCache):
     step = 256
 
-    def __init__(self, group_size: int = 64, bits: int = 8):
+    def __init__(self, group_size: int = 64, bits: int = 8, mode: str = "affine"):
+        if mode != "affine":
+            if mode not in _FP_QUANT_MODES:
+                raise ValueError(f"Unsupported KV cache quantization mode {mode}.")
+            group_size, bits = _FP_QUANT_MODES[mode]
         self.keys = None
         self.values = None
         self.offset = 0
         self.group_size = group_size
         self.bits = bits
+        self.mode = mode
 
     def update_and_fetch(self, keys, values):
         B, n_kv_heads, num_steps, k_head_dim = keys.shape
         v_head_dim = values.shape[-1]
         prev = self.offset
 
+        if self.keys is None:
+            self.group_size = _fit_group_size(
+                self.group_size, self.mode, k_head_dim, v_head_dim
+            )
+
         if self.keys is None or (prev + num_steps) > self.keys[0].shape[-2]:
             el_per_int = 8 * mx.uint32.size // self.bits
             new_steps = (self.step + num_steps - 1) // self.step * self.step
             shape = (B, n_kv_heads, new_steps)
 
             def init_quant(dim):
+                w = mx.zeros((*shape, dim // el_per_int), dtype=mx.uint32)
+                if self.mode != "affine":
+                    # The floating point modes store 8-bit scales and no biases
+                    scales = mx.zeros((*shape, dim // self.group_size), dtype=mx.uint8)
+                    return (w, scales)
                 return (
-                    mx.zeros((*shape, dim // el_per_int), dtype=mx.uint32),
+                    w,
                     mx.zeros((*shape, dim // self.group_size), dtype=keys.dtype),
                     mx.zeros((*shape, dim // self.group_size), dtype=keys.dtype),
                 )
@@ -263,8 +298,12 @@ class QuantizedKVCache(_BaseCache):
 
         self.offset += num_steps
 
-        keys = mx.quantize(keys, group_size=self.group_size, bits=self.bits)
-        values = mx.quantize(values, group_size=self.group_size, bits=self.bits)
+        keys = mx.quantize(
+            keys, group_size=self.group_size, bits=self.bits, mode=self.mode
+        )
+        values = mx.quantize(
+            values, group_size=self.group_size, bits=self.bits, mode=self.mode
+        )
         for i in range(len(self.keys)):
             self.keys[i][..., prev : self.offset, :] = keys[i]
             self.values[i][..., prev : self.offset, :] = values[i]
@@ -286,11 +325,13 @@ class QuantizedKVCache(_BaseCache):
 
     @property
     def meta_state(self):
-        return tuple(map(str, (self.offset, self.group_size, self.bits)))
+        return tuple(map(str, (self.offset, self.group_size, self.bits, self.mode)))
 
     @meta_state.setter
     def meta_state(self, v):
-        self.offset, self.group_size, self.bits = map(int, v)
+        self.offset, self.group_size, self.bits = map(int, v[:3])
+        # Caches saved before the mode was recorded are affine quantized
+        self.mode = v[3] if len(v) > 3 else "affine"
 
     def is_trimmable(self):
         return True
@@ -318,12 +359,18 @@ class KVCache(_BaseCache):
             B, n_kv_heads, _, k_head_dim = keys.shape
             v_head_dim = values.shape[3]
             n_steps = (self.step + keys.shape[2] - 1) // self.step
-            k_shape = (B, n_kv_heads, n_steps * self.step, k_head_dim)
-            v_shape = (B, n_kv_heads, n_steps * self.step, v_head_dim)
+            if self.keys is not None:
+                # Grow by up to a quarter of the current size so the existing
+                # entries are copied less often, while capping how much memory
+                # is reserved ahead of the live tokens
+                n_steps = max(n_steps, min(prev // (4 * self.step), 16))
+            new_size = n_steps * self.step
+            k_shape = (B, n_kv_heads, new_size, k_head_dim)
+            v_shape = (B, n_kv_heads, new_size, v_head_dim)
             new_k = mx.zeros(k_shape, keys.dtype)
             new_v = mx.zeros(v_shape, values.dtype)
             if self.keys is not None:
-                if prev % self.step != 0:
+                if prev < self.keys.shape[2]:
                     self.keys = self.keys[..., :prev, :]
                     self.values = self.values[..., :prev, :]
                 self.keys = mx.concatenate([self.keys, new_k], axis=2)
@@ -362,13 +409,25 @@ class KVCache(_BaseCache):
         self.offset -= n
         return n
 
-    def to_quantized(self, group_size: int = 64, bits: int = 4) -> QuantizedKVCache:
-        quant_cache = QuantizedKVCache(group_size=group_size, bits=bits)
+    def to_quantized(
+        self, group_size: int = 64, bits: int = 4, mode: str = "affine"
+    ) -> QuantizedKVCache:
+        quant_cache = QuantizedKVCache(group_size=group_size, bits=bits, mode=mode)
         quant_cache.offset = self.offset
         if self.keys is not None:
-            quant_cache.keys = mx.quantize(self.keys, group_size=group_size, bits=bits)
-            quant_cache.values = mx.quantize(
-                self.values, group_size=group_size, bits=bits
+            # Only quantize the live entries, not the spare buffer capacity
+            keys, values = self.state
+            quant_cache.group_size = _fit_group_size(
+                quant_cache.group_size, mode, keys.shape[-1], values.shape[-1]
+            )
+            quant_cache.keys, quant_cache.values = (
+                mx.quantize(
+                    x,
+                    group_size=quant_cache.group_size,
+                    bits=quant_cache.bits,
+                    mode=mode,
+                )
+                for x in (keys, values)
             )
         return quant_cache
 
@@ -419,22 +478,53 @@ class RotatingKVCache(_BaseCache):
         else:
             return v[..., : self._idx, :]
 
+    def _temporal_ranges(self, size):
+        """
+        The ``(start, end)`` ranges of the cache buffer which, concatenated,
+        put the cache in temporal order and trim it to at most
+        ``max_size - 1`` entries.
+        """
+        if self._idx == size:
+            ranges = [(0, size)]
+        elif self._idx < self.offset:
+            ranges = [(0, self.keep), (self._idx, size), (self.keep, self._idx)]
+        else:
+            ranges = [(0, self._idx)]
+
+        # Drop the oldest entries after the first keep tokens
+        trim_size = sum(e - s for s, e in ranges) - self.max_size + 1
+        if trim_size <= 0:
+            return ranges
+        trimmed = []
+        pos = 0
+        drop_start, drop_end = self.keep, self.keep + trim_size
+        for s, e in ranges:
+            n = e - s
+            if pos < drop_start:
+                trimmed.append((s, s + min(n, drop_start - pos)))
+            if pos + n > drop_end:
+                trimmed.append((s + max(0, drop_end - pos), e))
+            pos += n
+        return trimmed
+
     def _update_concat(self, keys, values):
         if self.keys is None:
             self.keys = keys
             self.values = values
         else:
-            # Put the keys/values in temporal order to
-            # preserve context
-            self.keys = self._temporal_order(self.keys)
-            self.values = self._temporal_order(self.values)
-            self._idx = self.keys.shape[2]
-
-            # The largest size is self.max_size + S - 1 to ensure
-            # every token gets at least self.max_size context
-            trim_size = self._idx - self.max_size + 1
-            self.keys = self._trim(trim_size, self.keys, keys)
-            self.values = self._trim(trim_size, self.values, values)
+            # Put the keys/values in temporal order to preserve context and
+            # trim them in a single concatenation. The largest size is
+            # self.max_size + S - 1 to ensure every token gets at least
+            # self.max_size context
+            ranges = self._temporal_ranges(self.keys.shape[2])
+            self.keys = mx.concatenate(
+                [self.keys[..., s:e, :] for s, e in ranges if e > s] + [keys],
+                axis=2,
+            )
+            self.values = mx.concatenate(
+                [self.values[..., s:e, :] for s, e in ranges if e > s] + [values],
+                axis=2,
+            )
         self.offset += keys.shape[2]
         self._idx = self.keys.shape[2]
         return self.keys, self.values
@@ -521,7 +611,9 @@ class RotatingKVCache(_BaseCache):
         self._idx -= n
         return n
 
-    def to_quantized(self, group_size: int = 64, bits: int = 4) -> QuantizedKVCache:
+    def to_quantized(
+        self, group_size: int = 64, bits: int = 4, mode: str = "affine"
+    ) -> QuantizedKVCache:
         raise NotImplementedError("RotatingKVCache Quantization NYI")
 
     def make_mask(
@@ -1150,7 +1242,9 @@ class BatchRotatingKVCache(_BaseCache):
         self.offset -= n
         return n
 
-    def to_quantized(self, group_size: int = 64, bits: int = 4) -> QuantizedKVCache:
+    def to_quantized(
+        self, group_size: int = 64, bits: int = 4, mode: str = "affine"
+    ) -> QuantizedKVCache:
         raise NotImplementedError("BatchRotatingKVCache Quantization NYI")
 
     def make_mask(
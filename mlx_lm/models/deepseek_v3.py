@@ -8,6 +8,7 @@ from typing import Any, Dict, Optional
 import mlx.core as mx
 import mlx.nn as nn
 from mlx.nn.layers.distributed import shard_inplace, shard_linear, sum_gradients
+from mlx.utils import tree_map
 
 from .base import BaseModelArgs, create_attention_mask, scaled_dot_product_attention
 from .pipeline import PipelineMixin
@@ -97,6 +98,16 @@ class DeepseekV3Attention(nn.Module):
             bias=config.attention_bias,
         )
 
+        # With a cache only the normalized latent and the rotated key
+        # positions are stored. Short inputs attend directly over the latent
+        # by folding kv_b_proj into the queries and outputs, longer ones
+        # expand the latent to per-head keys and values since that is less
+        # work once the input length passes this point.
+        extra = 2 * self.kv_lora_rank + self.qk_rope_head_dim
+        extra -= self.q_head_dim + self.v_head_dim
+        work = self.kv_lora_rank * (self.qk_nope_head_dim + self.v_head_dim)
+        self.max_absorbed_length = work / extra if extra > 0 else float("inf")
+
         if self.config.rope_scaling is not None:
             mscale_all_dim = self.config.rope_scaling.get("mscale_all_dim", 0)
             if mscale_all_dim:
@@ -113,6 +124,59 @@ class DeepseekV3Attention(nn.Module):
             scaling_config=self.config.rope_scaling,
         )
 
+    def _expand_latent(self, latent: mx.array, k_pe: mx.array):
+        B, _, L, _ = latent.shape
+        kv = self.kv_b_proj(latent).reshape(B, L, self.num_heads, -1)
+        k_nope, values = mx.split(
+            kv.transpose(0, 2, 1, 3), [self.qk_nope_head_dim], axis=-1
+        )
+        k_pe = mx.repeat(k_pe, self.num_heads, axis=1)
+        return mx.concatenate([k_nope, k_pe], axis=-1), values
+
+    def _absorbed_weights(self):
+        """
+        Split kv_b_proj per head into the projections from the latent to the
+        keys without rope and to the values. Quantized layers give tuples of
+        the weight, scales and biases.
+
+        The halves are views into kv_b_proj's arrays, so they take no extra
+        memory, and each head's matrix is row contiguous for the matmuls. They
+        are kept until kv_b_proj's arrays are replaced, e.g. by loading,
+        quantizing or casting the model.
+        """
+        proj = self.kv_b_proj
+        sources = [getattr(proj, k, None) for k in ("weight", "scales", "biases")]
+        cached = self.__dict__.get("_absorbed")
+        if cached is not None and all(a is b for a, b in zip(cached[0], sources)):
+            return cached[1]
+
+        def split(w):
+            if w is None:
+                return None, None
+            w = w.reshape(self.num_heads, -1, w.shape[-1])
+            return mx.split(w, [self.qk_nope_head_dim], axis=1)
+
+        if not hasattr(proj, "scales"):
+            weights = split(proj.weight)
+        else:
+            weights = tuple(zip(*map(split, sources)))
+        # Set it outside the module's parameters so it isn't saved or updated
+        object.__setattr__(self, "_absorbed", (sources, weights))
+        return weights
+
+    def _absorbed_matmul(self, x: mx.array, w, transpose: bool) -> mx.array:
+        if isinstance(w, tuple):
+            proj = self.kv_b_proj
+            return mx.quantized_matmul(
+                x,
+                *w,
+                transpose=transpose,
+                group_size=proj.group_size,
+                bits=proj.bits,
+                mode=proj.mode,
+            )
+        return x @ (w.swapaxes(-1, -2) if transpose else w)
+
     def __call__(
         self,
         x: mx.array,
@@ -131,29 +195,64 @@ class DeepseekV3Attention(nn.Module):
         compressed_kv = self.kv_a_proj_with_mqa(x)
         compressed_kv, k_pe = mx.split(compressed_kv, [self.kv_lora_rank], axis=-1)
         k_pe = k_pe.reshape(B, L, 1, self.qk_rope_head_dim).transpose(0, 2, 1, 3)
-        kv = self.kv_b_proj(self.kv_a_layernorm(compressed_kv))
-        kv = kv.reshape(B, L, self.num_heads, -1).transpose(0, 2, 1, 3)
-
-        k_nope, values = mx.split(kv, [self.qk_nope_head_dim], axis=-1)
+        latent = self.kv_a_layernorm(compressed_kv)[:, None]
 
-        if cache is not None:
-            q_pe = self.rope(q_pe, cache.offset)
-            k_pe = self.rope(k_pe, cache.offset)
-            k_pe = mx.repeat(k_pe, self.num_heads, axis=1)
-            keys, values = cache.update_and_fetch(
-                mx.concatenate([k_nope, k_pe], axis=-1), values
-            )
-        else:
+        if cache is None:
             q_pe = self.rope(q_pe)
             k_pe = self.rope(k_pe)
-            k_pe = mx.repeat(k_pe, self.num_heads, axis=1)
-            keys = mx.concatenate([k_nope, k_pe], axis=-1)
+            keys, values = self._expand_latent(latent, k_pe)
+            queries = mx.concatenate([q_nope, q_pe], axis=-1)
+            output = scaled_dot_product_attention(
+                queries, keys, values, cache=None, scale=self.scale, mask=mask
+            )
+        else:
+            q_pe = self.rope(q_pe, cache.offset)
+            k_pe = self.rope(k_pe, cache.offset)
+            cached_values = getattr(cache, "values", None)
+            if isinstance(cached_values, (list, tuple)):
+                cached_values = cached_values[0]
+            if cached_values is not None and cached_values.shape[-1] != 0:
+                raise ValueError(
+                    "The cache holds per-head keys and values but DeepSeek "
+                    "attention caches the MLA latent. Prompt caches saved in "
+                    "the old layout need to be recomputed."
+                )
 
-        queries = mx.concatenate([q_nope, q_pe], axis=-1)
+            # The values are the latent part of the keys, so the cached values
+            # are left empty rather than storing the latent twice
+            keys, _ = cache.update_and_fetch(
+                mx.concatenate([latent, k_pe], axis=-1), latent[..., :0]
+            )
+            if L <= self.max_absorbed_length and hasattr(self.kv_b_proj, "weight"):
+                # Quantized rows pack their weights and scales in order, so the
+                # latent is a leading slice of each of them too
+                dims = self.kv_lora_rank + self.qk_rope_head_dim
+                values = tree_map(
+                    lambda x: x[..., : x.shape[-1] * self.kv_lora_rank // dims], keys
+                )
+                w_uk, w_uv = self._absorbed_weights()
+                q_nope = self._absorbed_matmul(q_nope, w_uk, transpose=False)
+                queries = mx.concatenate([q_nope, q_pe], axis=-1)
+                output = scaled_dot_product_attention(
+                    queries, keys, values, cache=cache, scale=self.scale, mask=mask
+                )
+                output = self._absorbed_matmul(output, w_uv, transpose=True)
+            else:
+                if hasattr(cache, "bits"):
+                    keys = mx.dequantize(
+                        *keys,
+                        group_size=cache.group_size,
+                        bits=cache.bits,
+                        mode=cache.mode,
+                    )
+                keys, values = self._expand_latent(
+                    *mx.split(keys, [self.kv_lora_rank], axis=-1)
+                )
+                queries = mx.concatenate([q_nope, q_pe], axis=-1)
+                output = scaled_dot_product_attention(
+                    queries, keys, values, cache=None, scale=self.scale, mask=mask
+                )
 
-        output = scaled_dot_product_attention(
-            queries, keys, values, cache=cache, scale=self.scale, mask=mask
-        )
         output = output.transpose(0, 2, 1, 3).reshape(B, L, -1)
         return self.o_proj(output)
 
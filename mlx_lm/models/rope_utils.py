@@ -1,6 +1,7 @@
 # Copyright © 2023-2024 Apple Inc.
 
 import math
+from functools import lru_cache
 from typing import List, Optional, Union
 
 import mlx.core as mx
@@ -201,6 +202,40 @@ def initialize_rope(
     traditional,
     scaling_config: Optional[dict] = None,
     max_position_embeddings: Optional[int] = None,
+):
+    # The RoPE layers have no parameters, so the layers of a model (or of
+    # several models) with the same configuration can share one instance
+    if scaling_config is not None:
+        scaling_config = tuple(
+            sorted(
+                (k, tuple(v) if isinstance(v, list) else v)
+                for k, v in scaling_config.items()
+            )
+        )
+    try:
+        hash(scaling_config)
+    except TypeError:
+        return _make_rope(
+            dims, base, traditional, dict(scaling_config), max_position_embeddings
+        )
+    return _cached_rope(
+        dims, base, traditional, scaling_config, max_position_embeddings
+    )
+
+
+@lru_cache(maxsize=64)
+def _cached_rope(dims, base, traditional, scaling_config, max_position_embeddings):
+    if scaling_config is not None:
+        scaling_config = dict(scaling_config)
+    return _make_rope(dims, base, traditional, scaling_config, max_position_embeddings)
+
+
+def _make_rope(
+    dims,
+    base,
+    traditional,
+    scaling_config: Optional[dict] = None,
+    max_position_embeddings: Optional[int] = None,
 ):
     if scaling_config is not None:
         rope_type = scaling_config.get("type") or scaling_config.get(
@@ -9,12 +9,21 @@ from mlx.utils import tree_map
 
 from mlx_lm.models import rope_utils
 from mlx_lm.models.base import create_causal_mask, scaled_dot_product_attention
-from mlx_lm.models.cache import KVCache, RotatingKVCache, make_prompt_cache
+from mlx_lm.models.cache import (
+    KVCache,
+    QuantizedKVCache,
+    RotatingKVCache,
+    make_prompt_cache,
+)
 from mlx_lm.models.gated_delta import gated_delta_kernel, gated_delta_ops
 from mlx_lm.models.ssm import ssm_attn, ssm_update
 
 
 class TestModels(unittest.TestCase):
+    def tearDown(self):
+        # Don't carry freed buffers from one test's models into the next
+        mx.clear_cache()
+
     def test_kv_cache(self):
         cache = KVCache()
 
@@ -35,103 +44,169 @@ class TestModels(unittest.TestCase):
         self.assertTrue(mx.array_equal(v_up, expected))
         self.assertEqual(cache.offset, cache.step + 1)
 
+        # Growing the buffer several times preserves the contents
+        cache = KVCache()
+        chunks = [mx.random.uniform(shape=(1, 2, n, 8)) for n in [3, 300, 1, 600]]
+        for c in chunks:
+            k_up, v_up = cache.update_and_fetch(c, c)
+        expected = mx.concatenate(chunks, axis=2)
+        self.assertTrue(mx.array_equal(k_up, expected))
+        self.assertTrue(mx.array_equal(v_up, expected))
+        self.assertEqual(cache.offset, 904)
+
+        # Growing a long cache keeps the contents and reserves a bounded
+        # amount of spare capacity
+        for n in [4096, 65536]:
+            cache = KVCache()
+            k = mx.random.uniform(shape=(1, 2, n + 1, 32))
+            cache.update_and_fetch(k[..., :n, :], k[..., :n, :])
+            capacity = cache.keys.shape[2]
+            k_up, _ = cache.update_and_fetch(k[..., n:, :], k[..., n:, :])
+            self.assertTrue(mx.array_equal(k_up, k))
+            growth = cache.keys.shape[2] - capacity
+            self.assertTrue(cache.step <= growth <= 16 * cache.step)
+
+        # Only the live entries are quantized
+        quant_cache = cache.to_quantized(group_size=32, bits=8)
+        self.assertEqual(quant_cache.keys[0].shape[2], cache.offset)
+
     def test_rotating_kv_cache(self):
         b, h, d = 1, 2, 32
         cache = RotatingKVCache(max_size=8)
+        checks = []
 
-        k = mx.random.uniform(shape=(b, h, 2, d))
-        v = mx.random.uniform(shape=(b, h, 2, d))
+        # Slice every update from one pool of random keys and values
+        k_pool = mx.random.uniform(shape=(b, h, 64, d))
+        v_pool = mx.random.uniform(shape=(b, h, 64, d))
+        i = 0
 
+        k, v = k_pool[..., i : i + 2, :], v_pool[..., i : i + 2, :]
+        i += 2
         k_up, v_up = cache.update_and_fetch(k, v)
-        self.assertTrue(mx.array_equal(k_up, k))
-        self.assertTrue(mx.array_equal(v_up, v))
+        checks.append(mx.array_equal(k_up, k))
+        checks.append(mx.array_equal(v_up, v))
         self.assertEqual(cache.offset, 2)
 
-        k = mx.random.uniform(shape=(b, h, 5, d))
-        v = mx.random.uniform(shape=(b, h, 5, d))
+        k, v = k_pool[..., i : i + 5, :], v_pool[..., i : i + 5, :]
+        i += 5
         k_up, v_up = cache.update_and_fetch(k, v)
-        self.assertTrue(mx.array_equal(k_up[..., 2:, :], k))
-        self.assertTrue(mx.array_equal(v_up[..., 2:, :], v))
+        checks.append(mx.array_equal(k_up[..., 2:, :], k))
+        checks.append(mx.array_equal(v_up[..., 2:, :], v))
 
-        k = mx.random.uniform(shape=(b, h, 4, d))
-        v = mx.random.uniform(shape=(b, h, 4, d))
+        k, v = k_pool[..., i : i + 4, :], v_pool[..., i : i + 4, :]
+        i += 4
         k_up, v_up = cache.update_and_fetch(k, v)
-        self.assertTrue(mx.array_equal(k_up[..., -4:, :], k))
-        self.assertTrue(mx.array_equal(v_up[..., -4:, :], v))
+        checks.append(mx.array_equal(k_up[..., -4:, :], k))
+        checks.append(mx.array_equal(v_up[..., -4:, :], v))
 
         idx = 0
         for _ in range(10):
-            k = mx.random.uniform(shape=(b, h, 1, d))
-            v = mx.random.uniform(shape=(b, h, 1, d))
+            k, v = k_pool[..., i : i + 1, :], v_pool[..., i : i + 1, :]
+            i += 1
             k_up, v_up = cache.update_and_fetch(k, v)
-            self.assertTrue(mx.array_equal(k_up[..., idx : idx + 1, :], k))
-            self.assertTrue(mx.array_equal(v_up[..., idx : idx + 1, :], v))
+            checks.append(mx.array_equal(k_up[..., idx : idx + 1, :], k))
+            checks.append(mx.array_equal(v_up[..., idx : idx + 1, :], v))
             idx += 1
             idx %= 8
 
         # Try with nonzero keep
         cache = RotatingKVCache(max_size=8, keep=2)
+        i = 0
 
         # Check a large update
-        k = mx.random.uniform(shape=(b, h, 20, d))
-        v = mx.random.uniform(shape=(b, h, 20, d))
+        k, v = k_pool[..., i : i + 20, :], v_pool[..., i : i + 20, :]
+        i += 20
         k_up, v_up = cache.update_and_fetch(k, v)
-        self.assertTrue(mx.array_equal(k_up, k))
-        self.assertTrue(mx.array_equal(v_up, v))
+        checks.append(mx.array_equal(k_up, k))
+        checks.append(mx.array_equal(v_up, v))
 
         # A bunch of small updates
         self.assertEqual(cache.offset, 20)
         idx = 2
-        for i in range(10):
-            k = mx.random.uniform(shape=(b, h, 1, d))
-            v = mx.random.uniform(shape=(b, h, 1, d))
+        for j in range(10):
+            k, v = k_pool[..., i : i + 1, :], v_pool[..., i : i + 1, :]
+            i += 1
             k_up, v_up = cache.update_and_fetch(k, v)
-            self.assertTrue(mx.array_equal(k_up[..., idx : idx + 1, :], k))
-            self.assertTrue(mx.array_equal(v_up[..., idx : idx + 1, :], v))
-            self.assertEqual(cache.offset, 21 + i)
+            checks.append(mx.array_equal(k_up[..., idx : idx + 1, :], k))
+            checks.append(mx.array_equal(v_up[..., idx : idx + 1, :], v))
+            self.assertEqual(cache.offset, 21 + j)
             idx += 1
             if idx >= 8:
                 idx = 2
 
+        # A multi-token update after wrapping around keeps the first tokens
+        # and every new token sees at least max_size - 1 previous tokens
+        k, v = k_pool[..., i : i + 10, :], v_pool[..., i : i + 10, :]
+        i += 10
+        k_up, v_up = cache.update_and_fetch(k, v)
+        self.assertEqual(k_up.shape[2], 8 - 1 + 10)
+        checks.append(mx.array_equal(k_up[..., :2, :], k_pool[..., :2, :]))
+        checks.append(mx.array_equal(k_up[..., -10:, :], k))
+        checks.append(mx.array_equal(v_up[..., -10:, :], v))
+        checks.append(
+            mx.array_equal(k_up[..., 2:7, :], k_pool[..., i - 15 : i - 10, :])
+        )
+        self.assertEqual(cache.offset, 40)
+
+        # Evaluate all the comparisons at once
+        mx.eval(checks)
+        for c in checks:
+            self.assertTrue(c)
+
     def test_rotating_kv_cache_chat_mode(self):
         # Test that the rotating kv cache can handle
         # alternating prompt/prefill with generation
         d = 4
         h = 2
         cache = RotatingKVCache(max_size=18)
+        checks = []
 
-        x = mx.random.uniform(shape=(1, h, 8, d))
+        pool = mx.random.uniform(shape=(1, h, 64, d))
+        i = 0
+
+        x = pool[..., i : i + 8, :]
+        i += 8
         k, v = cache.update_and_fetch(x, x)
         self.assertEqual(k.shape[2], 8)
         self.assertEqual(cache.offset, 8)
 
-        x = mx.random.uniform(shape=(1, h, 1, d))
+        x = pool[..., i : i + 1, :]
+        i += 1
         k, v = cache.update_and_fetch(x, x)
         self.assertEqual(k.shape[2], 9)
         self.assertEqual(cache.offset, 9)
-        self.assertTrue(mx.allclose(x, k[..., 8:9, :]))
+        checks.append(mx.allclose(x, k[..., 8:9, :]))
 
-        x = mx.random.uniform(shape=(1, h, 2, d))
+        x = pool[..., i : i + 2, :]
+        i += 2
         k, v = cache.update_and_fetch(x, x)
         self.assertEqual(k.shape[2], 11)
         self.assertEqual(cache.offset, 11)
-        self.assertTrue(mx.allclose(x, k[..., 9:11, :]))
+        checks.append(mx.allclose(x, k[..., 9:11, :]))
 
-        x = mx.random.uniform(shape=(1, h, 3, d))
+        x = pool[..., i : i + 3, :]
+        i += 3
         k, v = cache.update_and_fetch(x, x)
         self.assertEqual(k.shape[2], 14)
         self.assertEqual(cache.offset, 14)
-        self.assertTrue(mx.allclose(x, k[..., 11:14, :]))
+        checks.append(mx.allclose(x, k[..., 11:14, :]))
 
-        x = mx.random.uniform(shape=(1, h, 6, d))
+        x = pool[..., i : i + 6, :]
+        i += 6
         k, v = cache.update_and_fetch(x, x)
         self.assertEqual(cache.offset, 20)
-        self.assertTrue(mx.allclose(x, k[..., -6:, :]))
+        checks.append(mx.allclose(x, k[..., -6:, :]))
 
-        x = mx.random.uniform(shape=(1, h, 2, d))
+        x = pool[..., i : i + 2, :]
+        i += 2
         k, v = cache.update_and_fetch(x, x)
         self.assertEqual(cache.offset, 22)
-        self.assertTrue(mx.allclose(x, k[..., -2:, :]))
+        checks.append(mx.allclose(x, k[..., -2:, :]))
+
+        # Evaluate all the comparisons at once
+        mx.eval(checks)
+        for c in checks:
+            self.assertTrue(c)
 
     def test_causal_mask_padding(self):
         right_padding = mx.array([2, 1, 0])
@@ -238,6 +313,30 @@ class TestModels(unittest.TestCase):
         )
         self.assertTrue(isinstance(rope, rope_utils.Llama3RoPE))
 
+        # Identical configurations share an instance
+        scaling_config = {
+            "type": "longrope",
+            "original_max_position_embeddings": 4096,
+            "short_factor": [1.0] * 16,
+            "long_factor": [1.0] * 16,
+        }
+        rope = rope_utils.initialize_rope(
+            32, 100, False, dict(scaling_config), max_position_embeddings=8192
+        )
+        self.assertTrue(isinstance(rope, rope_utils.SuScaledRoPE))
+        self.assertIs(
+            rope,
+            rope_utils.initialize_rope(
+                32, 100, False, dict(scaling_config), max_position_embeddings=8192
+            ),
+        )
+        self.assertIsNot(
+            rope,
+            rope_utils.initialize_rope(
+                32, 100, False, dict(scaling_config), max_position_embeddings=4096
+            ),
+        )
+
     def test_quantized_sdpa(self):
         cache = KVCache()
 
@@ -274,11 +373,142 @@ class TestModels(unittest.TestCase):
         )
         self.assertTrue(mx.allclose(out, qout, rtol=1e-2, atol=1e-2))
 
+    def test_quantized_sdpa_int4(self):
+        cache = KVCache()
+
+        k = 1e-1 * mx.random.normal(shape=(1, 1, 256, 32))
+        v = 1e-1 * mx.random.normal(shape=(1, 1, 256, 32))
+
+        cache.update_and_fetch(k, v)
+        quant_cache = cache.to_quantized(group_size=32, bits=4)
+
+        k = 1e-1 * mx.random.normal(shape=(1, 1, 1, 32))
+        v = 1e-1 * mx.random.normal(shape=(1, 1, 1, 32))
+
+        k_up, v_up = cache.update_and_fetch(k, v)
+        qk_up, qv_up = quant_cache.update_and_fetch(k, v)
+
+        # Eight 4-bit values are packed in each uint32
+        self.assertEqual(qk_up[0].shape, (1, 1, 257, 32 // 8))
+
+        q = 1e-1 * mx.random.normal(shape=(1, 4, 257, 32))
+        out = scaled_dot_product_attention(
+            q, k_up, v_up, cache=cache, mask="causal", scale=1.0
+        )
+        qout = scaled_dot_product_attention(
+            q, qk_up, qv_up, cache=quant_cache, mask="causal", scale=1.0
+        )
+        self.assertTrue(mx.allclose(out, qout, rtol=5e-2, atol=5e-2))
+
+    def test_sdpa_matches_reference(self):
+        def reference(q, k, v, scale, mask):
+            n_repeats = q.shape[1] // k.shape[1]
+            k = mx.repeat(k, n_repeats, axis=1)
+            v = mx.repeat(v, n_repeats, axis=1)
+            scores = (q * scale) @ k.swapaxes(-1, -2)
+            scores = mx.where(mask, scores, mx.finfo(scores.dtype).min)
+            return mx.softmax(scores, axis=-1, precise=True) @ v
+
+        # Decode (a single query) and prefill with grouped query attention
+        for L, S in [(1, 300), (200, 200)]:
+            q = mx.random.normal(shape=(1, 8, L, 64))
+            k = mx.random.normal(shape=(1, 2, S, 64))
+            v = mx.random.normal(shape=(1, 2, S, 64))
+            mask = "causal" if L > 1 else None
+            out = scaled_dot_product_attention(
+                q, k, v, cache=None, mask=mask, scale=0.125
+            )
+            expected = reference(q, k, v, 0.125, create_causal_mask(L, S - L))
+            self.assertTrue(mx.allclose(out, expected, atol=1e-4, rtol=1e-4))
+
+    def test_sdpa_low_precision(self):
+        # Half precision inputs match the float32 result within tolerance
+        q = mx.random.normal(shape=(1, 8, 128, 64))
+        k = mx.random.normal(shape=(1, 2, 128, 64))
+        v = mx.random.normal(shape=(1, 2, 128, 64))
+        expected = scaled_dot_product_attention(
+            q, k, v, cache=None, mask="causal", scale=0.125
+        )
+        for t in [mx.float16, mx.bfloat16]:
+            out = scaled_dot_product_attention(
+                q.astype(t),
+                k.astype(t),
+                v.astype(t),
+                cache=None,
+                mask="causal",
+                scale=0.125,
+            )
+            self.assertEqual(out.dtype, t)
+            self.assertTrue(mx.allclose(out, expected, atol=5e-2, rtol=5e-2))
+
+    def test_causal_sdpa(self):
+        cache = KVCache()
+        k = 1e-1 * mx.random.normal(shape=(1, 2, 64, 32))
+        v = 1e-1 * mx.random.normal(shape=(1, 2, 64, 32))
+        k_up, v_up = cache.update_and_fetch(k, v)
+        quant_cache = cache.to_quantized(group_size=32, bits=8)
+        qk_up, qv_up = quant_cache.state
+
+        for L in [1, 5]:
+            q = 1e-1 * mx.random.normal(shape=(1, 4, L, 32))
+            mask = create_causal_mask(L, 64 - L)
+            for c, keys, values in [(cache, k_up, v_up), (quant_cache, qk_up, qv_up)]:
+                out = scaled_dot_product_attention(
+                    q, keys, values, cache=c, mask="causal", scale=1.0
+                )
+                expected = scaled_dot_product_attention(
+                    q, keys, values, cache=c, mask=mask, scale=1.0
+                )
+                self.assertTrue(mx.allclose(out, expected, atol=1e-5, rtol=1e-5))
+
+    def test_fp8_quantized_sdpa(self):
+        cache = KVCache()
+
+        k = 1e-1 * mx.random.normal(shape=(1, 1, 256, 32))
+        v = 1e-1 * mx.random.normal(shape=(1, 1, 256, 32))
+
+        cache.update_and_fetch(k, v)
+        # The group size and bits follow from the mode
+        quant_cache = cache.to_quantized(mode="mxfp8")
+        self.assertEqual((quant_cache.group_size, quant_cache.bits), (32, 8))
+        self.assertEqual(len(quant_cache.keys), 2)
+        nvfp4_cache = QuantizedKVCache(mode="nvfp4")
+        self.assertEqual((nvfp4_cache.group_size, nvfp4_cache.bits), (16, 4))
+
+        k = 1e-1 * mx.random.normal(shape=(1, 1, 300, 32))
+        v = 1e-1 * mx.random.normal(shape=(1, 1, 300, 32))
+
+        k_up, v_up = cache.update_and_fetch(k, v)
+        qk_up, qv_up = quant_cache.update_and_fetch(k, v)
+
+        q = 1e-1 * mx.random.normal(shape=(1, 4, 300, 32))
+        out = scaled_dot_product_attention(
+            q, k_up, v_up, cache=cache, mask="causal", scale=1.0
+        )
+        qout = scaled_dot_product_attention(
+            q, qk_up, qv_up, cache=quant_cache, mask="causal", scale=1.0
+        )
+        self.assertTrue(mx.allclose(out, qout, rtol=5e-2, atol=5e-2))
+
+    def test_quantized_kv_cache_row_groups(self):
+        # Group sizes larger than the head dimension quantize whole rows
+        k = mx.random.normal(shape=(1, 2, 4, 32))
+        cache = KVCache()
+        cache.update_and_fetch(k, k)
+        quant_cache = cache.to_quantized(group_size=64, bits=8)
+        self.assertEqual(quant_cache.group_size, 32)
+        self.assertEqual(quant_cache.keys[1].shape[-1], 1)
+
+        quant_cache = QuantizedKVCache(group_size=128, bits=8)
+        qk_up, _ = quant_cache.update_and_fetch(k, k)
+        self.assertEqual(quant_cache.group_size, 32)
+        self.assertEqual(qk_up[1].shape, (1, 2, 4, 1))
+
     def model_test_runner(self, model, model_type, vocab_size, num_layers):
         self.assertEqual(len(model.layers), num_layers)
         self.assertEqual(model.model_type, model_type)
 
-        for t in [mx.float32, mx.float16]:
+        for t in [mx.float32, mx.float16, mx.bfloat16]:
             model.update(tree_map(lambda p: p.astype(t), model.parameters()))
 
             inputs = mx.array([[0, 1]])
@@ -291,7 +521,8 @@ class TestModels(unittest.TestCase):
             self.assertEqual(outputs.shape, (1, 2, vocab_size))
             self.assertEqual(outputs.dtype, t)
 
-            outputs = model(mx.argmax(outputs[0, -1:, :], keepdims=True), cache=cache)
+            # Only the output shape and dtype are checked so any token will do
+            outputs = model(inputs[:, -1:], cache=cache)
             self.assertEqual(outputs.shape, (1, 1, vocab_size))
             self.assertEqual(outputs.dtype, t)
 
@@ -975,6 +1206,73 @@ class TestModels(unittest.TestCase):
             model, args.model_type, args.vocab_size, args.num_hidden_layers
         )
 
+    def test_deepseek_latent_cache(self):
+        from mlx_lm.models import deepseek_v2, deepseek_v3
+
+        rope_scaling = {
+            "beta_fast": 32,
+            "beta_slow": 1,
+            "factor": 40,
+            "mscale": 1.0,
+            "mscale_all_dim": 1.0,
+            "original_max_position_embeddings": 4096,
+            "type": "yarn",
+        }
+        for module in [deepseek_v2, deepseek_v3]:
+            with self.subTest(model=module.__name__):
+                mx.random.seed(0)
+                args = module.ModelArgs(
+                    model_type=module.__name__.split(".")[-1],
+                    vocab_size=128,
+                    hidden_size=128,
+                    intermediate_size=256,
+                    moe_intermediate_size=256,
+                    num_hidden_layers=2,
+                    num_attention_heads=4,
+                    num_key_value_heads=4,
+                    kv_lora_rank=64,
+                    q_lora_rank=32,
+                    qk_rope_head_dim=32,
+                    v_head_dim=16,
+                    qk_nope_head_dim=32,
+                    rope_scaling=rope_scaling,
+                )
+                model = module.Model(args)
+                inputs = mx.random.randint(0, args.vocab_size, (1, 52))
+                expected = model(inputs)
+
+                # The long prompt expands the latent, the single token steps
+                # attend over it directly
+                cache = make_prompt_cache(model)
+                outputs = [model(inputs[:, :48], cache=cache)]
+                for i in range(48, 52):
+                    outputs.append(model(inputs[:, i : i + 1], cache=cache))
+                outputs = mx.concatenate(outputs, axis=1)
+                self.assertTrue(mx.allclose(outputs, expected, atol=1e-4))
+
+                # Only a single head of the latent and rope dims is cached
+                keys, values = cache[0].state
+                latent_dims = args.kv_lora_rank + args.qk_rope_head_dim
+                self.assertEqual(keys.shape, (1, 1, 52, latent_dims))
+                self.assertEqual(values.size, 0)
+
+                # Caches saved with per-head keys and values are rejected
+                old_cache = make_prompt_cache(model)
+                q_head_dim = args.qk_nope_head_dim + args.qk_rope_head_dim
+                old_cache[0].update_and_fetch(
+                    mx.zeros((1, args.num_attention_heads, 4, q_head_dim)),
+                    mx.zeros((1, args.num_attention_heads, 4, args.v_head_dim)),
+                )
+                with self.assertRaises(ValueError):
+                    model(inputs[:, :1], cache=old_cache)
+
+                # The split of kv_b_proj is reused until its weights change
+                attn = model.model.layers[0].self_attn
+                weights = attn._absorbed_weights()
+                self.assertIs(attn._absorbed_weights(), weights)
+                attn.kv_b_proj.weight = attn.kv_b_proj.weight * 2
+                self.assertIsNot(attn._absorbed_weights(), weights)
+
     def test_gemma2(self):
         from mlx_lm.models import gemma2
 
@@ -1080,6 +1378,8 @@ class TestModels(unittest.TestCase):
             num_hidden_layers=4,
             num_attention_heads=4,
             num_key_value_heads=4,
+            num_local_experts=2,
+            num_experts_per_tok=2,
             rope_scaling={
                 "long_factor": [1.0] * 16,
                 "long_mscale": 1.243163121016122,
@@ -1224,10 +1524,14 @@ class TestModels(unittest.TestCase):
 
         args = cohere2.ModelArgs(
             model_type="cohere2",
-            hidden_size=4096,
-            head_dim=128,
-            num_hidden_layers=40,
-            sliding_window=4096,
+            hidden_size=128,
+            head_dim=32,
+            num_hidden_layers=4,
+            intermediate_size=256,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            vocab_size=1000,
+            sliding_window=32,
             sliding_window_pattern=4,
         )
         model = cohere2.Model(args)
@@ -1289,7 +1593,7 @@ class TestModels(unittest.TestCase):
         )
         model = smollm3.Model(args)
         self.model_test_runner(
-            model, "smollm3", args.vocab_size, args.num_hidden_layers
+            model, args.model_type, args.vocab_size, args.num_hidden_layers
         )
 
     def test_gpt_oss(self):
@@ -7,7 +7,7 @@ import unittest
 
 import mlx.core as mx
 
-from mlx_lm.generate import generate_step
+from mlx_lm.generate import check_quantized_prompt_cache, generate_step
 from mlx_lm.models.base import create_attention_mask, create_causal_mask
 from mlx_lm.models.cache import (
     ArraysCache,
@@ -315,6 +315,26 @@ class TestPromptCache(unittest.TestCase):
             self.assertEqual(tok, toks[i])
             self.assertTrue(mx.allclose(logits, all_logits[i], rtol=4e-2))
 
+    def test_check_quantized_prompt_cache(self):
+        # Rows of 32-dim heads are quantized whole with the default group size
+        cache = KVCache()
+        x = mx.random.normal(shape=(1, 2, 8, 32))
+        cache.update_and_fetch(x, x)
+        cache_file = os.path.join(self.test_dir, "prompt_cache.safetensors")
+        save_prompt_cache(cache_file, [cache.to_quantized(group_size=64, bits=8)])
+        loaded_cache = load_prompt_cache(cache_file)
+        self.assertEqual(loaded_cache[0].group_size, 32)
+
+        # The same flags used to make the cache pass the check
+        check_quantized_prompt_cache(loaded_cache, 8, 64)
+        check_quantized_prompt_cache(loaded_cache, None, 32)
+        with self.assertRaises(ValueError):
+            check_quantized_prompt_cache(loaded_cache, 4, 64)
+        with self.assertRaises(ValueError):
+            check_quantized_prompt_cache(loaded_cache, 8, 16)
+        with self.assertRaises(ValueError):
+            check_quantized_prompt_cache(loaded_cache, 8, 64, "mxfp8")
+
     def test_cache_list(self):
         c = CacheList(KVCache(), KVCache())
         self.assertTrue(c.is_trimmable())